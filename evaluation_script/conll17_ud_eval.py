@@ -24,10 +24,13 @@
 #                              characters are a strict prefix of gold
 #                              file characters.
 # - [25 Jan 2018] Version 1.3: Explicitly add MPL 2.0 license.
+# - [19 Oct 2026] Version 1.4: Optionally report the k worst sentences
+#                              of every metric computed on aligned words.
+#                              Add ELAS metric for enhanced dependencies.
 
 # Command line usage
 # ------------------
-# conll17_ud_eval.py [-v] [-w weights_file] gold_conllu_file system_conllu_file
+# conll17_ud_eval.py [-v] [-w weights_file] [-k worst_sentences] gold_conllu_file system_conllu_file
 #
 # - if no -v is given, only the CoNLL17 UD Shared Task evaluation LAS metrics
 #   is printed
@@ -48,6 +51,17 @@
 # - if custom weights_file is given (with lines containing deprel-weight pairs),
 #   one more metric (a generalization of CLAS) is shown:
 #   - WeightedLAS: as LAS, but each deprel (ignoring subtypes) has different weight
+# - if the gold file contains enhanced dependencies (the DEPS column), one more
+#   metric is shown:
+#   - ELAS: using aligned words, how well do the enhanced dependencies
+#     (HEAD+DEPREL including subtypes) match; precision and recall are computed
+#     on edges and the edges going through empty nodes are collapsed into
+#     a single edge with deprels joined by '>' (e.g., 'conj>nsubj'); AligndAcc
+#     is also computed on edges, as the ratio of correct edges to all gold
+#     edges of aligned words
+# - if -k is given, the k sentences with the largest number of errors are printed
+#   for every shown metric computed on aligned words, together with the line
+#   numbers where the sentence starts in the gold and in the system file
 
 # API usage
 # ---------
@@ -55,11 +69,19 @@
 #   - loads CoNLL-U file from given file object to an internal representation
 #   - the file object should return str in both Python 2 and Python 3
 #   - raises UDError exception if the given file cannot be loaded
-# - evaluate(gold_ud, system_ud)
+# - evaluate(gold_ud, system_ud, deprel_weights=None, worst_sentences=None)
 #   - evaluate the given gold and system CoNLL-U files (loaded with load_conllu)
 #   - raises UDError if the concatenated tokens of gold and system file do not match
 #   - returns a dictionary with the metrics described above, each metric having
 #     three fields: precision, recall and f1
+#   - if worst_sentences=k is given, every metric computed on aligned words
+#     also has a field worst_sentences, a list of at most k sentences with
+#     the largest loss (in decreasing order), each with fields
+#     - loss: number of gold and system words in the sentence not counted as correct
+#     - sentence: index of the sentence in gold_ud.sentences
+#     - gold_line, system_line: line numbers (1-based) where the sentence starts
+#       in the gold and in the system file
+#     Words are assigned to gold sentences using their spans.
 
 # Description of token matching
 # -----------------------------
@@ -93,6 +115,8 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import bisect
+import heapq
 import io
 import sys
 import unittest
@@ -125,6 +149,11 @@ def load_conllu(file):
             self.words = []
             # List of UDSpan instances with start&end indices into `characters`.
             self.sentences = []
+            # Line numbers (1-based) of the first line of every sentence
+            # (including its comments), so that sentences can be located in the file.
+            self.sentence_lines = []
+            # enhanced==True means that some word or empty node has non-empty DEPS.
+            self.enhanced = False
     class UDSpan:
         def __init__(self, start, end):
             self.start = start
@@ -142,27 +171,49 @@ def load_conllu(file):
             self.is_multiword = is_multiword
             # Reference to the UDWord instance representing the HEAD (or None if root).
             self.parent = None
+            # Set of (head, deprel) pairs of enhanced dependencies, where head is
+            # the UDWord instance representing the head (or 0 if root, or None
+            # if the head in DEPS is invalid).
+            self.deps = frozenset()
             # Let's ignore language-specific deprel subtypes.
             self.columns[DEPREL] = columns[DEPREL].split(':')[0]
 
     ud = UDRepresentation()
 
+    # Parse DEPS column into a list of (head ID, deprel) pairs. The column is not
+    # validated, invalid head IDs are represented by None when resolving the heads.
+    def parse_deps(deps):
+        if deps == "_":
+            return []
+        ud.enhanced = True
+
+        edges = []
+        for dep in deps.split("|"):
+            head, _, deprel = dep.partition(":")
+            edges.append((head, deprel))
+        return edges
+
     # Load the CoNLL-U file
-    index, sentence_start = 0, None
+    index, sentence_start, empty_nodes = 0, None, {}
+    line_number, sentence_line = 0, None
     while True:
         line = file.readline()
         if not line:
             break
         line = line.rstrip("\r\n")
+        line_number += 1
 
         # Handle sentence start boundaries
         if sentence_start is None:
+            if sentence_line is None:
+                sentence_line = line_number
             # Skip comments
             if line.startswith("#"):
                 continue
             # Start a new sentence
             ud.sentences.append(UDSpan(index, 0))
-            sentence_start = len(ud.words)
+            ud.sentence_lines.append(sentence_line)
+            sentence_start, empty_nodes = len(ud.words), {}
         if not line:
             # Add parent UDWord links and check there are no cycles
             def process_word(word):
@@ -185,9 +236,47 @@ def load_conllu(file):
             if len([word for word in ud.words[sentence_start:] if word.parent is None]) != 1:
                 raise UDError("There are multiple roots in a sentence")
 
+            # Add enhanced dependencies, collapsing the edges going through
+            # empty nodes into a single edge with a deprel path. Heads which
+            # cannot be resolved (invalid IDs, cycles of empty nodes) are
+            # represented by None, which never matches, so that invalid DEPS
+            # do not prevent evaluation of the other metrics.
+            def resolve_dep(head, deprel, empty_path):
+                if head == "0":
+                    return [(0, deprel)]
+                if head in empty_nodes:
+                    edges = [(empty_head, empty_deprel + ">" + deprel)
+                             for empty_head, empty_deprel in resolve_empty_node(head, empty_path)]
+                    return edges or [(None, deprel)]
+                try:
+                    head_id = int(head)
+                except:
+                    head_id = 0
+                if head_id <= 0 or head_id > len(ud.words) - sentence_start:
+                    return [(None, deprel)]
+                return [(ud.words[sentence_start + head_id - 1], deprel)]
+
+            def resolve_empty_node(node, empty_path):
+                if node not in resolved_empty_nodes:
+                    if node in empty_path:
+                        return [(None, "")]
+                    resolved_empty_nodes[node] = [edge for head, deprel in empty_nodes[node]
+                                                  for edge in resolve_dep(head, deprel, empty_path + (node,))]
+                return resolved_empty_nodes[node]
+
+            # Resolve every empty node only once
+            resolved_empty_nodes = {}
+            for node in empty_nodes:
+                resolve_empty_node(node, ())
+
+            for word in ud.words[sentence_start:]:
+                if word.columns[DEPS] != "_":
+                    word.deps = frozenset(edge for head, deprel in parse_deps(word.columns[DEPS])
+                                          for edge in resolve_dep(head, deprel, ()))
+
             # End the sentence
             ud.sentences[-1].end = index
-            sentence_start = None
+            sentence_start, sentence_line = None, None
             continue
 
         # Read next token/word
@@ -195,8 +284,9 @@ def load_conllu(file):
         if len(columns) != 10:
             raise UDError("The CoNLL-U line does not contain 10 tab-separated columns: '{}'".format(line))
 
-        # Skip empty nodes
+        # Store enhanced dependencies of empty nodes, which are not words
         if "." in columns[ID]:
+            empty_nodes[columns[ID]] = parse_deps(columns[DEPS])
             continue
 
         # Delete spaces from FORM, so gold.characters == system.characters
@@ -219,6 +309,7 @@ def load_conllu(file):
 
             for _ in range(start, end + 1):
                 word_line = file.readline().rstrip("\r\n")
+                line_number += 1
                 word_columns = word_line.split("\t")
                 if len(word_columns) != 10:
                     raise UDError("The CoNLL-U line does not contain 10 tab-separated columns: '{}'".format(word_line))
@@ -247,13 +338,25 @@ def load_conllu(file):
     return ud
 
 # Evaluate the gold and system treebanks (loaded using load_conllu).
-def evaluate(gold_ud, system_ud, deprel_weights=None):
+def evaluate(gold_ud, system_ud, deprel_weights=None, worst_sentences=None):
     class Score:
         def __init__(self, gold_total, system_total, correct, aligned_total=None):
             self.precision = correct / system_total if system_total else 0.0
             self.recall = correct / gold_total if gold_total else 0.0
             self.f1 = 2 * correct / (system_total + gold_total) if system_total + gold_total else 0.0
             self.aligned_accuracy = correct / aligned_total if aligned_total else aligned_total
+            # List of SentenceLoss instances, filled only for metrics computed
+            # on aligned words and only if worst_sentences is given.
+            self.worst_sentences = None
+    class SentenceLoss:
+        def __init__(self, loss, sentence, gold_line, system_line):
+            # Number of (weighted) gold and system words not counted as correct.
+            self.loss = loss
+            # Index of the sentence in gold_ud.sentences.
+            self.sentence = sentence
+            # Line numbers of the beginning of the sentence in gold and system file.
+            self.gold_line = gold_line
+            self.system_line = system_line
     class AlignmentWord:
         def __init__(self, gold_word, system_word):
             self.gold_word = gold_word
@@ -299,27 +402,92 @@ def evaluate(gold_ud, system_ud, deprel_weights=None):
 
         return Score(len(gold_spans), len(system_spans), correct)
 
+    def sentence_indices(sentences, words):
+        # Assign the words (sorted by their spans) to the given sentences
+        # in a single linear pass.
+        indices, sentence = [], 0
+        for word in words:
+            while sentence + 1 < len(sentences) and sentences[sentence + 1].start <= word.span.start:
+                sentence += 1
+            indices.append(sentence)
+        return indices
+
+    def select_worst_sentences(losses):
+        # Keep only the k worst sentences, using a heap of size k.
+        worst = heapq.nlargest(worst_sentences, range(len(losses)), key=lambda i: losses[i])
+        system_starts = [sentence.start for sentence in system_ud.sentences]
+        return [SentenceLoss(losses[i], i, gold_ud.sentence_lines[i],
+                             system_ud.sentence_lines[bisect.bisect_right(system_starts, gold_ud.sentences[i].start) - 1])
+                for i in worst if losses[i] > 0]
+
     def alignment_score(alignment, key_fn, weight_fn=lambda w: 1):
         gold, system, aligned, correct = 0, 0, 0, 0
+        # Per-sentence losses, only if worst_sentences are requested
+        losses = [0] * len(gold_ud.sentences) if worst_sentences else None
 
-        for word in alignment.gold_words:
+        for i, word in enumerate(alignment.gold_words):
             gold += weight_fn(word)
+            if losses is not None:
+                losses[gold_word_sentences[i]] += weight_fn(word)
 
-        for word in alignment.system_words:
+        for i, word in enumerate(alignment.system_words):
             system += weight_fn(word)
+            if losses is not None:
+                losses[system_word_sentences[i]] += weight_fn(word)
 
-        for words in alignment.matched_words:
+        for i, words in enumerate(alignment.matched_words):
             aligned += weight_fn(words.gold_word)
+            # If key_fn is None, whole aligned words are scored
+            if key_fn is None or \
+                    key_fn(words.gold_word, words.gold_parent) == key_fn(words.system_word, words.system_parent_gold_aligned):
+                correct += weight_fn(words.gold_word)
+                if losses is not None:
+                    losses[matched_word_sentences[i]] -= 2 * weight_fn(words.gold_word)
 
-        if key_fn is None:
-            # Return score for whole aligned words
-            return Score(gold, system, aligned)
+        score = Score(gold, system, correct, aligned if key_fn is not None else None)
+        if losses is not None:
+            score.worst_sentences = select_worst_sentences(losses)
 
-        for words in alignment.matched_words:
-            if key_fn(words.gold_word, words.gold_parent) == key_fn(words.system_word, words.system_parent_gold_aligned):
-                correct += weight_fn(words.gold_word)
+        return score
+
+    def enhanced_score(alignment):
+        # Enhanced dependencies are scored as edges, so the totals count edges.
+        gold, system, aligned, correct = 0, 0, 0, 0
+        losses = [0] * len(gold_ud.sentences) if worst_sentences else None
 
-        return Score(gold, system, correct, aligned)
+        for i, word in enumerate(alignment.gold_words):
+            gold += len(word.deps)
+            if losses is not None:
+                losses[gold_word_sentences[i]] += len(word.deps)
+
+        for i, word in enumerate(alignment.system_words):
+            system += len(word.deps)
+            if losses is not None:
+                losses[system_word_sentences[i]] += len(word.deps)
+
+        for i, words in enumerate(alignment.matched_words):
+            aligned += len(words.gold_word.deps)
+            if not words.gold_word.deps or not words.system_word.deps:
+                continue
+
+            # Represent system heads by the aligned gold words, so the edges can be
+            # compared to the gold ones. Edges with invalid or not aligned heads
+            # are left out, as they cannot match (invalid gold heads are None too).
+            system_deps = set()
+            for head, deprel in words.system_word.deps:
+                head = alignment.matched_words_map.get(head, None) if head != 0 else 0
+                if head is not None:
+                    system_deps.add((head, deprel))
+            matching = len(words.gold_word.deps & system_deps)
+            correct += matching
+            if losses is not None:
+                losses[matched_word_sentences[i]] -= 2 * matching
+
+        score = Score(gold, system, correct, aligned)
+        if losses is not None:
+            score.worst_sentences = select_worst_sentences(losses)
+
+        return score
 
     def beyond_end(words, i, multiword_span_end):
         if i >= len(words):
@@ -426,6 +594,13 @@ def evaluate(gold_ud, system_ud, deprel_weights=None):
     # Align words
     alignment = align_words(gold_ud.words, system_ud.words)
 
+    # Assign gold words, system words and aligned words to gold sentences
+    # according to their spans, so that all errors are attributed to gold sentences.
+    if worst_sentences:
+        gold_word_sentences = sentence_indices(gold_ud.sentences, alignment.gold_words)
+        system_word_sentences = sentence_indices(gold_ud.sentences, alignment.system_words)
+        matched_word_sentences = sentence_indices(gold_ud.sentences, [words.gold_word for words in alignment.matched_words])
+
     def weighted_las(weights):
         return (lambda word: weights.get(word.columns[DEPREL], 1.0))
 
@@ -448,6 +623,10 @@ def evaluate(gold_ud, system_ud, deprel_weights=None):
     if deprel_weights is not None:
         result["WeightedLAS"] = alignment_score(alignment, lambda w, parent: (parent, w.columns[DEPREL]), weighted_las(deprel_weights))
 
+    # Add ELAS if the gold data contain enhanced dependencies
+    if gold_ud.enhanced:
+        result["ELAS"] = enhanced_score(alignment)
+
     return result
 
 def load_deprel_weights(weights_file):
@@ -480,7 +659,16 @@ def evaluate_wrapper(args):
     # Load weights if requested
     deprel_weights = load_deprel_weights(args.weights)
 
-    return evaluate(gold_ud, system_ud, deprel_weights)
+    return evaluate(gold_ud, system_ud, deprel_weights, args.worst_sentences)
+
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number <= 0:
+        raise argparse.ArgumentTypeError("invalid positive int value: '{}'".format(value))
+    return number
 
 def main():
     # Parse arguments
@@ -494,6 +682,8 @@ def main():
                         help="Compute WeightedLAS using given weights for Universal Dependency Relations.")
     parser.add_argument("--verbose", "-v", default=0, action="count",
                         help="Print all metrics.")
+    parser.add_argument("--worst_sentences", "-k", type=positive_int, default=None, metavar="k",
+                        help="Print k sentences with the most errors for every metric on aligned words.")
     args = parser.parse_args()
 
     # Use verbose if weights are supplied
@@ -505,11 +695,14 @@ def main():
 
     # Print the evaluation
     if not args.verbose:
+        metrics = ["LAS"]
         print("LAS F1 Score: {:.2f}".format(100 * evaluation["LAS"].f1))
     else:
         metrics = ["Tokens", "Sentences", "Words", "UPOS", "XPOS", "Feats", "AllTags", "Lemmas", "UAS", "LAS", "CLAS"]
         if args.weights is not None:
             metrics.append("WeightedLAS")
+        if "ELAS" in evaluation:
+            metrics.append("ELAS")
 
         print("Metrics    | Precision |    Recall |  F1 Score | AligndAcc")
         print("-----------+-----------+-----------+-----------+-----------")
@@ -522,6 +715,19 @@ def main():
                 "{:10.2f}".format(100 * evaluation[metric].aligned_accuracy) if evaluation[metric].aligned_accuracy is not None else ""
             ))
 
+    # Print the worst sentences if requested
+    if args.worst_sentences:
+        for metric in metrics:
+            if evaluation[metric].worst_sentences is None:
+                continue
+            print()
+            print("Worst {} sentences".format(metric))
+            print("Sentence   | Gold line |  Sys line |      Loss")
+            print("-----------+-----------+-----------+-----------")
+            for sentence in evaluation[metric].worst_sentences:
+                print("{:<11d}|{:10d} |{:10d} |{:10g}".format(
+                    sentence.sentence + 1, sentence.gold_line, sentence.system_line, sentence.loss))
+
 if __name__ == "__main__":
     main()
 
@@ -574,3 +780,64 @@ class TestAlignment(unittest.TestCase):
         self._test_ok(["abc a BX c", "def d EX f"], ["ab a b", "cd c d", "ef e f"], 4)
         self._test_ok(["ab a b", "cd bc d"], ["a", "bc", "d"], 2)
         self._test_ok(["a", "bc b c", "d"], ["ab AX BX", "cd CX a"], 1)
+
+class TestWorstSentences(unittest.TestCase):
+    @staticmethod
+    def _load(sentences):
+        """Prepare fake CoNLL-U file, each sentence given as a list of (form, upos) pairs."""
+        lines = []
+        for sentence in sentences:
+            lines.append("# comment")
+            for i, (form, upos) in enumerate(sentence):
+                lines.append("{}\t{}\t_\t{}\t_\t_\t{}\t_\t_\t_".format(i + 1, form, upos, int(i > 0)))
+            lines.append("")
+        return load_conllu((io.StringIO if sys.version_info >= (3, 0) else io.BytesIO)("\n".join(lines+[""])))
+
+    def test_worst_sentences(self):
+        gold = self._load([[("a", "X")], [("b", "X"), ("c", "X")], [("d", "X"), ("e", "X")]])
+        system = self._load([[("a", "X")], [("b", "Y"), ("c", "X"), ("d", "Y"), ("e", "Y")]])
+        metrics = evaluate(gold, system, worst_sentences=2)
+        self.assertEqual([(s.sentence, s.loss, s.gold_line, s.system_line) for s in metrics["UPOS"].worst_sentences],
+                         [(2, 4, 8, 4), (1, 2, 4, 4)])
+        self.assertEqual(metrics["Words"].worst_sentences, [])
+        self.assertEqual(metrics["Tokens"].worst_sentences, None)
+
+    def test_no_worst_sentences(self):
+        gold = self._load([[("a", "X")]])
+        self.assertEqual(evaluate(gold, gold)["UPOS"].worst_sentences, None)
+
+class TestEnhancedDependencies(unittest.TestCase):
+    @staticmethod
+    def _load(deps, empty_deps=None):
+        """Prepare fake CoNLL-U file with given DEPS, optionally with an empty node 1.1."""
+        lines = []
+        for i, dep in enumerate(deps):
+            lines.append("{}\tw{}\t_\t_\t_\t_\t{}\t_\t{}\t_".format(i + 1, i + 1, int(i > 0), dep))
+            if i == 0 and empty_deps is not None:
+                lines.append("1.1\te\t_\t_\t_\t_\t_\t_\t{}\t_".format(empty_deps))
+        return load_conllu((io.StringIO if sys.version_info >= (3, 0) else io.BytesIO)("\n".join(lines+["\n"])))
+
+    def test_collapse_empty_nodes(self):
+        ud = self._load(["0:root", "1.1:nsubj|1:dep"], "1:conj")
+        self.assertEqual(ud.words[1].deps, frozenset([(ud.words[0], "conj>nsubj"), (ud.words[0], "dep")]))
+
+    def test_invalid_deps(self):
+        self.assertEqual(self._load(["0:root", "1.2:nsubj"], "1:conj").words[1].deps, frozenset([(None, "nsubj")]))
+        self.assertEqual(self._load(["0:root", "3:nsubj"]).words[1].deps, frozenset([(None, "nsubj")]))
+        self.assertEqual([head for head, deprel in self._load(["0:root", "1.1:nsubj"], "1.1:conj").words[1].deps], [None])
+        self.assertEqual(self._load(["0:root", "root"]).words[1].deps, frozenset([(None, "")]))
+
+    def test_invalid_deps_evaluation(self):
+        # Invalid system DEPS do not prevent evaluation against gold without DEPS
+        for system_deps in ["3:dep", "root"]:
+            metrics = evaluate(self._load(["_", "_"]), self._load(["_", system_deps]))
+            self.assertEqual(metrics["LAS"].f1, 1.0)
+        # Invalid heads never match, not even invalid gold heads
+        metrics = evaluate(self._load(["0:root", "3:dep"]), self._load(["0:root", "3:dep"]))
+        self.assertEqual((metrics["ELAS"].precision, metrics["ELAS"].recall), (0.5, 0.5))
+
+    def test_elas(self):
+        gold = self._load(["0:root", "1:nsubj|1:obj"])
+        metrics = evaluate(gold, self._load(["0:root", "1:obj"]))
+        self.assertEqual((metrics["ELAS"].precision, metrics["ELAS"].recall), (1.0, 2 / 3))
+        self.assertNotIn("ELAS", evaluate(self._load(["_", "_"]), self._load(["0:root", "1:obj"])))